@@ -7,41 +7,72 @@
 # NOTE: a helper variable is included in this package called thisNetAffilVec.npy that can be used for the input thisNetAffilVec. This is based on the Cole Anticevic brain wide network partition (CABNP) (see Ji et al., 2019 or https://github.com/ColeLab/ColeAnticevicNetPartition). In addition, network names (in proper order 1-12, or 0-11 in python indexing) can be found in networkNamesCABNP_Long.npy (and corresponding acronyms in netNamesCABNP_Short.npy).
 
 import numpy as np 
+from functools import lru_cache
+
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+
+if njit is not None:
+    @njit(parallel=True)
+    def _node_net_strengths(fcArray,netLabels,numNets):
+        # Per node: total strength and strength to each network (NaN edges skipped, as in np.nansum), 1 pass over each row (same copy in participation_coefficient_sign.py; keep the two in sync)
+        nVertsInGraph = fcArray.shape[0]
+        degreeOfROIs = np.zeros(nVertsInGraph)
+        netStrengths = np.zeros((nVertsInGraph,numNets))
+        for nodeNum in prange(nVertsInGraph):
+            for colNum in range(fcArray.shape[1]):
+                fcVal = fcArray[nodeNum,colNum]
+                if not np.isnan(fcVal):
+                    degreeOfROIs[nodeNum] += fcVal
+                    netNum = netLabels[colNum]
+                    if netNum >= 0 and netNum < numNets:
+                        netStrengths[nodeNum,netNum] += fcVal
+        return degreeOfROIs.astype(np.float32), netStrengths.astype(np.float32) # accumulated in double precision
+else:
+    _node_net_strengths = None
+
+@lru_cache(maxsize=4)
+def _affil_onehot(affilBytes,numNets):
+    # One-hot (nodes x networks) membership matrix for an affiliation vector (passed as float64 bytes so it can be cached);
+    # the same vector is passed in for every subject, so it is only built once (same copy in participation_coefficient_sign.py; keep the two in sync)
+    thisNetAffilVec = np.frombuffer(affilBytes,dtype=np.float64)
+    netMembership = (thisNetAffilVec[:,None]==np.arange(1,numNets+1)[None,:]).astype(np.float32) # +1 bc py indexing (but need non-zero network numbers in function)
+    netMembership.flags.writeable = False # shared between calls
+    return netMembership
 
 def diversity_coef_sign(fcArray,thisNetAffilVec,numNets):
     '''
     # INPUTS:
-    # fcArray = a connectivity array of size: nodes x nodes x task conditions; either as-is or adjusted for pos/neg before hand (i.e., can mask for positive values, then run the function for just positive weights to get a positive DC); also sorted to network partition beforehand. NOTE: the recommended use is to pre-index fcArray over subjects and iteratively call this module, for example using fcArray[:,:,:,subject_index] as the fcArray input.
+    # fcArray = a connectivity array of size: nodes x nodes x task conditions (computed in float32); either as-is or adjusted for pos/neg before hand (i.e., can mask for positive values, then run the function for just positive weights to get a positive DC); also sorted to network partition beforehand. NOTE: the recommended use is to pre-index fcArray over subjects and iteratively call this module, for example using fcArray[:,:,:,subject_index] as the fcArray input.
     # thisNetAffilVec = m, network assignment (i.e., affiliation) vector (note: start numbering at 1); this sorting should match fcArray
     # numNets = number of networks in thisNetAffilVec; should equal largest integer in that thisNetAffilVec
 
     # OUTPUTS: 
     # shannonDiversity = m, vector of diversity coefficients for each parent node 
     '''
-    nVertsInGraph = int(len(fcArray))
+    fcArray = np.ascontiguousarray(fcArray,dtype=np.float32)
     nModules = int(np.nanmax(thisNetAffilVec))
-    degreeOfROIs = np.nansum(fcArray,axis=1)
     
     # Node-to-module degree
-    arrHere = np.zeros((nVertsInGraph,nModules))
-    for netNum in range(1,nModules+1): # +1 bc py indexing (but need non-zero network numbers in function)
-        netIxsHere = np.where(thisNetAffilVec==netNum)[0]
-        arrHere[:,netNum-1] = np.nansum(fcArray[:,netIxsHere],axis=1)
+    if _node_net_strengths is not None:
+        # numba: degrees and node-to-module degrees in 1 jitted pass over fcArray
+        netLabels = np.nan_to_num(thisNetAffilVec).astype(np.int64) - 1
+        degreeOfROIs, arrHere = _node_net_strengths(fcArray,netLabels,nModules)
+    else:
+        degreeOfROIs = np.nansum(fcArray,axis=1)
+        netMembership = _affil_onehot(np.asarray(thisNetAffilVec,dtype=np.float64).tobytes(),nModules) # 1 matrix product with a one-hot (nodes x modules) membership matrix
+        arrHere = np.nan_to_num(fcArray) @ netMembership # NaN edges add 0, as with np.nansum
         
-    repDegrees = np.transpose([degreeOfROIs] * nModules) # repeat the sum vec from above into columns of an arr (num of columns = num of nets); note that brackets are needed around var
-    pArrHere = arrHere / repDegrees # elementwise divide
-    
-    # Find nodes with NaN and set to 0 
-    nanIxsHereR,nanIxsHereC = np.where(np.isnan(pArrHere))
-    pArrHere[nanIxsHereR,nanIxsHereC] = 0
+    pArrHere = arrHere / degreeOfROIs[:,None] # elementwise divide; degrees broadcast across the columns (nets)
     
-    # Find nodes with 0 scores and set to 1 
-    zeroIxsHereR,zeroIxsHereC = np.where(pArrHere==0)
-    pArrHere[zeroIxsHereR,zeroIxsHereC] = 1
+    # Find nodes with NaN (set to 0) or 0 scores, and set to 1 (so they add p*log(p) = 0 below)
+    pArrHere = np.where(np.isnan(pArrHere) | (pArrHere==0),1.0,pArrHere)
     
     # Compute "H" or diversity coefficient
     pArrHere_Log = np.log(pArrHere)
-    nModules_Log = np.log(nModules)
+    nModules_Log = np.log(np.float32(nModules))
     # Note that element-wise multiplication (Hadamard) in PYTHON uses just the asterisk; but np.multiply() can be used too
     pArrHere_Transformed = pArrHere * pArrHere_Log
     shannonDiversity = (np.sum(pArrHere_Transformed,axis=1)/nModules_Log) * -1
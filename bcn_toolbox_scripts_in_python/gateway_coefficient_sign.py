@@ -13,7 +13,7 @@ import numpy as np
 def gateway_coefficient_sign(fcArray,thisNetAffilVec,numNets,centType='node_strength'):
     '''
     # INPUTS:
-    # fcArray = a connectivity array of size: nodes x nodes x task conditions; either as-is or adjusted for pos/neg before hand (i.e., can mask for positive values, then run the function for just positive weights to get a positive DC); also sorted to network partition beforehand. NOTE: the recommended use is to pre-index fcArray over subjects and iteratively call this module, for example using fcArray[:,:,:,subject_index] as the fcArray input.
+    # fcArray = a connectivity array of size: nodes x nodes x task conditions (computed in float32); either as-is or adjusted for pos/neg before hand (i.e., can mask for positive values, then run the function for just positive weights to get a positive DC); also sorted to network partition beforehand. NOTE: the recommended use is to pre-index fcArray over subjects and iteratively call this module, for example using fcArray[:,:,:,subject_index] as the fcArray input.
     # thisNetAffilVec = m, network assignment (i.e., affiliation) vector (note: start numbering at 1); this sorting should match fcArray
     # numNets = number of networks in thisNetAffilVec; should equal largest integer in that thisNetAffilVec
     # centType: a string either 'node_strength' (default) or 'betweenness'; which centrality measure to use 
@@ -23,67 +23,62 @@ def gateway_coefficient_sign(fcArray,thisNetAffilVec,numNets,centType='node_stre
     '''
     
     nVertsInGraph = int(len(fcArray))
+    fcArray = np.array(fcArray,dtype=np.float32) # always a copy, so the NaN --> 0 and diagonal writes below never reach the caller's array
+    fcArray = np.nan_to_num(fcArray,copy=False) # NaN edges --> 0 once, so plain sums can be used from here on
     np.fill_diagonal(fcArray,0) # zero out diagonal
-    degreeOfROIs = np.nansum(fcArray,axis=1)
-    netAffilMask = np.matmul((fcArray!=0),(np.diag(thisNetAffilVec)))
-    nModules = int(np.nanmax(thisNetAffilVec))
-
-    ksArr = np.zeros((nVertsInGraph,nModules))
-    kjsArr = np.zeros((nVertsInGraph,nModules))
-    csArr = np.zeros((nVertsInGraph,nModules))
+    degreeOfROIs = np.sum(fcArray,axis=1)
+    nModules = int(numNets)
+    netLabels = np.nan_to_num(thisNetAffilVec).astype(int) - 1 # -1 for py indexing
+    validNodes = (netLabels>=0) & (netLabels<nModules) # unassigned nodes (label 0 or NaN), or labels above numNets, belong to no network
+    validIxs = np.where(validNodes)[0]
+    netSizes = np.bincount(netLabels[validNodes],minlength=nModules)
 
     if centType=='node_strength':
-        centVec = degreeOfROIs.copy()
+        centVec = degreeOfROIs
     elif centType=='betweenness': # MATLAB original code uses 2 helper functions: weight_conversion.m (with 'lengths') and betweenness_wei.m 
-        thisFC_Inverted = 1/fcArray # invert weights (element-wise)
+        thisFC_Inverted = np.zeros_like(fcArray,dtype=float)
+        np.divide(1,fcArray,out=thisFC_Inverted,where=(fcArray!=0)) # invert weights (element-wise); absent (0) edges stay 0, as in weight_conversion.m
         # centVec = betweenness_weigh(thisFC_Inverted) # *** TBA: adapt betweenness_wei as an extra helper function
 
-    maxSummedCentrality = 0 
-    for netNum in range(1,numNets+1): # +1 adjustment for py
-        thisNetIx = np.where(thisNetAffilVec==netNum)[0]
-        if np.nansum(centVec[thisNetIx]) > maxSummedCentrality:
-            maxSummedCentrality = np.nansum(centVec[thisNetIx])
-
-        netAffilMask_Binary = netAffilMask==netNum
-        ksArr[:,netNum-1] = np.nansum(fcArray * netAffilMask_Binary,axis=1)
+    # Sort columns by network so each network is a contiguous block, then sum all blocks in one pass (reduceat)
+    netOrder = validIxs[np.argsort(netLabels[validNodes],kind='stable')] # unassigned nodes' columns are left out
+    # Networks with no nodes are left out of the reduceat (it cannot take empty segments) and left at 0
+    netStarts = np.searchsorted(netLabels[netOrder],np.arange(nModules))[netSizes>0]
+    ksArr = np.zeros((nVertsInGraph,nModules),dtype=np.float32)
+    ksArr[:,netSizes>0] = np.add.reduceat(fcArray[:,netOrder],netStarts,axis=1) # node-to-network strengths
+    summedCentrality = np.zeros(nModules,dtype=np.float32)
+    summedCentrality[netSizes>0] = np.add.reduceat(centVec[netOrder],netStarts)
+    maxSummedCentrality = np.max(summedCentrality,initial=0)
 
-    for netNum in range(1,numNets+1):
-        numNodesInNet = np.where(thisNetAffilVec==netNum)[0].shape[0]
-        if numNodesInNet>1:
-            thisNetIx = np.where(thisNetAffilVec==netNum)[0]
-            ksHere = ksArr[thisNetIx,:].copy()
-            ksSum = np.nansum(ksHere,axis=0)
-            ksSum_Tile = np.tile(ksSum,(numNodesInNet,1)) # this is to replicate the matlab matrix multiplication effect (which in their use was just repeating the vector over rows)
-            #kjsArr[thisNetIx,:] = np.matmul(np.ones(numNodesInNet),np.nansum(ksHere,axis=0))
-            kjsArr[thisNetIx,:] = ksSum_Tile.copy()
-            kjsArr[thisNetIx,netNum-1] = kjsArr[thisNetIx,netNum-1]/2 # account for redundancy
+    # Sum ksArr over the nodes of each network, then give every node its own network's sums (the matlab code does this with ones(n,1)*sum(...))
+    ksSumByNet = np.zeros((nModules,nModules),dtype=np.float32)
+    np.add.at(ksSumByNet,netLabels[validNodes],ksArr[validNodes])
+    kjsArr = np.zeros((nVertsInGraph,nModules),dtype=np.float32)
+    kjsArr[validNodes] = ksSumByNet[netLabels[validNodes]]
+    ownNetIxs = (validIxs,netLabels[validNodes]) # each node's own-network column
+    kjsArr[ownNetIxs] = kjsArr[ownNetIxs]/2 # account for redundancy
+    kjsArr[validIxs[netSizes[netLabels[validNodes]]<=1],:] = 0 # single-node networks are skipped (left at 0), as are unassigned nodes
 
-    for nodeNum in range(nVertsInGraph):
-        if degreeOfROIs[nodeNum]>0:
-            for netNum in range(1,numNets+1):
-                fcNeighbors = fcArray[:,nodeNum].copy()
-                fcNeighbors_Binary = fcNeighbors > 0
-                netAffilsAdj = thisNetAffilVec * fcNeighbors_Binary # zero out network numbers corresponding to 0 FC weights (of neighbors of ROI)
-                netIxsHereAdj = np.where(netAffilsAdj==netNum)[0]
-                centHere = centVec[netIxsHereAdj].copy()
-                csArr[nodeNum,netNum-1] = np.nansum(centHere)
+    # Summed centrality of each node's positively connected neighbors, per network: binary neighbors x (network one-hot weighted by centrality)
+    fcNeighbors_Binary = (fcArray > 0).astype(np.float32)
+    netCentralities = np.zeros((nVertsInGraph,nModules),dtype=np.float32)
+    netCentralities[validIxs,netLabels[validNodes]] = centVec[validNodes]
+    csArr = fcNeighbors_Binary.T @ netCentralities
+    csArr[degreeOfROIs<=0,:] = 0 # only nodes with positive degree are counted
 
     # Normalize
     ksNormed = ksArr/kjsArr # normalize total weight of connections per node by total connections
-    nanIxsHereR,nanIxsHereC = np.where(np.isnan(ksNormed)) # account for NaNs from dividing by 0s in some cases
-    ksNormed[nanIxsHereR,nanIxsHereC] = 0
+    ksNormed[np.isnan(ksNormed)] = 0 # account for NaNs from dividing by 0s in some cases
     csNormed = csArr / maxSummedCentrality # normalize sum of centralities of neighbors by the max summed centrality
 
     # Compute gateway
     gsTotal = np.square((1-(ksNormed * csNormed))) # total weightings
-    ksArr_Squared = np.square(ksArr) 
+    gsTotal[np.isnan(gsTotal)] = 0 # e.g., inf*0 for single-node networks; these terms are dropped from the sum (as np.nansum did)
     degreeOfROIs_Squared = np.square(degreeOfROIs)
-    gatewayCoef = 1-np.nansum(((ksArr_Squared.T/degreeOfROIs_Squared).T * gsTotal),axis=1) # use transpose to mimic matlab's ability to do element-wise 2D x 1D 
+    invDegrees_Squared = np.divide(1,degreeOfROIs_Squared,out=np.zeros_like(degreeOfROIs_Squared),where=degreeOfROIs_Squared>0) # nodes with 0 degree contribute 0
+    gatewayCoef = 1-np.einsum('ij,ij,i->i',ksArr*ksArr,gsTotal,invDegrees_Squared,optimize=True) # sum over networks of (k_is/k_i)^2 * g_is
 
-    # make sure NaNs and 0s = 0
-    nanIxsGC = np.where(np.isnan(gatewayCoef))[0]
-    gatewayCoef[nanIxsGC] = 0
-    zeroIxsGC = np.where(gatewayCoef==0)[0]
-    gatewayCoef[zeroIxsGC] = 0
+    # make sure NaNs = 0
+    gatewayCoef = np.nan_to_num(gatewayCoef,copy=False,nan=0.0,posinf=np.inf,neginf=-np.inf)
     
     return gatewayCoef
\ No newline at end of file
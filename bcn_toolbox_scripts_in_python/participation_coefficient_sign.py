@@ -9,11 +9,45 @@
 # NOTE: a helper variable is included in this package called thisNetAffilVec.npy that can be used for the input thisNetAffilVec. This is based on the Cole Anticevic brain wide network partition (CABNP) (see Ji et al., 2019 or https://github.com/ColeLab/ColeAnticevicNetPartition). In addition, network names (in proper order 1-12, or 0-11 in python indexing) can be found in networkNamesCABNP_Long.npy (and corresponding acronyms in netNamesCABNP_Short.npy).
 
 import numpy as np
+from functools import lru_cache
+
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+
+if njit is not None:
+    @njit(parallel=True)
+    def _node_net_strengths(fcArray,netLabels,numNets):
+        # Per node: total strength and strength to each network (NaN edges skipped, as in np.nansum), 1 pass over each row (same copy in diversity_coef_sign.py; keep the two in sync)
+        nVertsInGraph = fcArray.shape[0]
+        degreeOfROIs = np.zeros(nVertsInGraph)
+        netStrengths = np.zeros((nVertsInGraph,numNets))
+        for nodeNum in prange(nVertsInGraph):
+            for colNum in range(fcArray.shape[1]):
+                fcVal = fcArray[nodeNum,colNum]
+                if not np.isnan(fcVal):
+                    degreeOfROIs[nodeNum] += fcVal
+                    netNum = netLabels[colNum]
+                    if netNum >= 0 and netNum < numNets:
+                        netStrengths[nodeNum,netNum] += fcVal
+        return degreeOfROIs.astype(np.float32), netStrengths.astype(np.float32) # accumulated in double precision
+else:
+    _node_net_strengths = None
+
+@lru_cache(maxsize=4)
+def _affil_onehot(affilBytes,numNets):
+    # One-hot (nodes x networks) membership matrix for an affiliation vector (passed as float64 bytes so it can be cached);
+    # the same vector is passed in for every subject, so it is only built once (same copy in diversity_coef_sign.py; keep the two in sync)
+    thisNetAffilVec = np.frombuffer(affilBytes,dtype=np.float64)
+    netMembership = (thisNetAffilVec[:,None]==np.arange(1,numNets+1)[None,:]).astype(np.float32) # +1 bc py indexing (but need non-zero network numbers in function)
+    netMembership.flags.writeable = False # shared between calls
+    return netMembership
 
 def participation_coefficient_sign(fcArray,thisNetAffilVec,numNets):
     '''
     # INPUTS:
-    # fcArray = a connectivity array of size: nodes x nodes x task conditions; either as-is or adjusted for pos/neg before hand (i.e., can mask for positive values, then run the function for just positive weights to get a positive PC); also sorted to network partition beforehand. NOTE: the recommended use is to pre-index fcArray over subjects and iteratively call this module, for example using fcArray[:,:,:,subject_index] as the fcArray input.
+    # fcArray = a connectivity array of size: nodes x nodes x task conditions (computed in float32); either as-is or adjusted for pos/neg before hand (i.e., can mask for positive values, then run the function for just positive weights to get a positive PC); also sorted to network partition beforehand. NOTE: the recommended use is to pre-index fcArray over subjects and iteratively call this module, for example using fcArray[:,:,:,subject_index] as the fcArray input.
     # thisNetAffilVec = m, network assignment (i.e., affiliation) vector (note: start numbering at 1); this sorting should match fcArray
     # numNets = number of networks in thisNetAffilVec; should equal largest integer in that thisNetAffilVec
 
@@ -21,23 +55,24 @@ def participation_coefficient_sign(fcArray,thisNetAffilVec,numNets):
     # partCoef = m, vector of participation scores for each parent node 
     '''
     
-    # Set up community affiliation on-diag array with binary mask; 0-weighted edges will be masked out
+    # Set up community affiliation as a one-hot (nodes x networks) membership matrix; 0-weighted edges add nothing to the sums below
     # Note: b/c of python indexing, use +1 for network assignments
     nVertsInGraph = len(fcArray) # number of vertices
-    degreeOfROIs = np.nansum(fcArray,axis=1) # degree/strength of "parent" regions (or targets in Cole lab convention)
-    netAffilMask = np.matmul((fcArray!=0),(np.diag(thisNetAffilVec))) # community specific neighbors; note that * used in matlab = matrix multiplication
-    #netAffilMask = np.dot((fcArray!=0),(np.diag(thisNetAffilVec))) # in this case matmul and dot would produce equal arrays
+    fcArray = np.ascontiguousarray(fcArray,dtype=np.float32)
+    if _node_net_strengths is not None:
+        # numba: degrees and node-to-network strengths in 1 jitted pass over fcArray
+        netLabels = np.nan_to_num(thisNetAffilVec).astype(np.int64) - 1
+        degreeOfROIs, sumVecs = _node_net_strengths(fcArray,netLabels,numNets)
+    else:
+        fcZeroed = np.where(np.isnan(fcArray),0,fcArray) # NaN edges --> 0 (inf is kept, as with np.nansum); no n x n affiliation mask is built
+        degreeOfROIs = np.sum(fcZeroed,axis=1) # degree/strength of "parent" regions (or targets in Cole lab convention)
+        netMembership = _affil_onehot(np.asarray(thisNetAffilVec,dtype=np.float64).tobytes(),numNets) # community specific neighbors
+        sumVecs = fcZeroed @ netMembership # node-to-network strengths for all networks in 1 matrix product
     
-    # Build up degrees/strengths
-    arrHere = np.zeros((nVertsInGraph));
-    for netNum in range(1,numNets+1):
-        # Note that element-wise multiplication (Hadamard) in PYTHON uses just the asterisk; but np.multiply() can be used too
-        vecHere = fcArray * (netAffilMask==netNum) # equal to using np.muliply(fcArray,(netAffilMask==netNum))
-        sumVec = np.nansum(vecHere,axis=1) # collapse 0s columns; NOTE: may need to deal with "-0"s here
-        squareVec = np.square(sumVec) # can also use np.power(sumVec,2) or the double asterisk sumVec**2
-        arrHere = arrHere + squareVec 
-
-    partCoef = np.ones((nVertsInGraph))
+    # Build up degrees/strengths: sum of squares across networks
+    arrHere = np.sum(np.square(sumVecs),axis=1)
+
+    partCoef = np.ones((nVertsInGraph),dtype=np.float32)
     squareDegrees = np.square(degreeOfROIs)
     # to avoid divide by 0 errors, set to nan (/0 will = nan anyway, this just removes the error msg; nans handled later)
     zeroIxsSquareDegrees = np.where(squareDegrees==0)[0] 
@@ -45,19 +80,7 @@ def participation_coefficient_sign(fcArray,thisNetAffilVec,numNets):
         squareDegrees[zeroIxsSquareDegrees] = np.nan
     partCoef = partCoef - (arrHere/squareDegrees)
     
-    # Find nodes with NaN participation coefficient and set PC score to 0
-    nanInP = np.where(np.isnan(partCoef))[0]
-    if not nanInP.shape[0]==0:
-        partCoef[nanInP] = 0
-    
-    # Find nodes that had no out neighbors and set PC score to 0 (from original)
-    zerosInFC = np.where(degreeOfROIs==0)[0] 
-    if not zerosInFC.shape[0]==0:
-        partCoef[zerosInFC] = 0 
-        
-    # Find nodes that had no out neighbors and set PC score to 0 (from _sign function)
-    zerosInP = np.where(partCoef==0)[0] 
-    if not zerosInP.shape[0]==0:
-        partCoef[zerosInP] = 0 
+    # Find nodes with NaN participation coefficient, or that had no out neighbors, and set PC score to 0
+    partCoef[np.isnan(partCoef) | (degreeOfROIs==0)] = 0
         
     return partCoef
\ No newline at end of file
@@ -15,17 +15,92 @@
 # Also see input list notes below for tips and useful helper arrays included in this package.
 
 import numpy as np
-
-def deviation(fcArray,netBoundaries,nodeOrder,useMeanFirst=False,useRestPartitionAdjuster=False,netBoundariesNew=None,nodeOrderNew=None):
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+
+if njit is not None:
+    @njit(parallel=True)
+    def _clustered_prefs(fcArray,sortOrder,startNodes,endNodes):
+        # Fused sort --> network mean (NaNs skipped, as in np.nanmean) --> max/argmax, read straight from the unsorted (subjects x tasks x nodes x nodes) fcArray
+        numSubjs = fcArray.shape[0]
+        numTasks = fcArray.shape[1]
+        nParcels = fcArray.shape[2]
+        numNets = startNodes.shape[0]
+        nodePrefVals = np.zeros((nParcels,numTasks,numSubjs),dtype=np.float32)
+        nodePrefIdxs = np.zeros((nParcels,numTasks,numSubjs))
+        for taskSubj in prange(numTasks*numSubjs):
+            taskNum = taskSubj % numTasks
+            subjNum = taskSubj // numTasks
+            for nodeNum in range(nParcels):
+                rowIx = sortOrder[nodeNum]
+                maxVal = -np.inf
+                maxIdx = 0
+                for netNum in range(numNets):
+                    clusterSum = 0.0
+                    clusterCount = 0
+                    for colNum in range(startNodes[netNum],endNodes[netNum]):
+                        fcVal = fcArray[subjNum,taskNum,rowIx,sortOrder[colNum]]
+                        if not np.isnan(fcVal):
+                            clusterSum += fcVal
+                            clusterCount += 1
+                    clusterMean = clusterSum / clusterCount if clusterCount > 0 else np.nan
+                    if np.isnan(clusterMean): # np.max/np.argmax stop at the first NaN
+                        maxVal = np.nan
+                        maxIdx = netNum
+                        break
+                    if clusterMean > maxVal:
+                        maxVal = clusterMean
+                        maxIdx = netNum
+                nodePrefVals[nodeNum,taskNum,subjNum] = maxVal
+                nodePrefIdxs[nodeNum,taskNum,subjNum] = maxIdx
+        return nodePrefVals, nodePrefIdxs
+else:
+    _clustered_prefs = None
+
+def _cluster_by_network(x,startNodes,netSizes=None,axis=0):
+    # Mean over each network's nodes along axis: networks are contiguous blocks of sorted nodes, so one segmented sum (reduceat) covers all networks.
+    # If netSizes is given, x is taken to be NaN-free and sums are divided by network sizes; otherwise NaNs are left out of both the sums and
+    # the counts (same as np.nanmean per network). Same copy in gvc_plus_partition.py; keep the two in sync
+    # Networks with no nodes (e.g., a [k, k-1, 0] row from restPartitionAdjuster) come out as NaN; they are left out of the reduceat, which
+    # cannot take empty segments
+    nonEmptyNets = np.diff(np.append(startNodes,x.shape[axis]))>0
+    netIxs = (slice(None),)*axis + (nonEmptyNets,)
+    outShape = list(x.shape)
+    outShape[axis] = len(startNodes)
+    netMeans = np.full(outShape,np.nan)
+    if netSizes is not None:
+        sizeShape = [1] * x.ndim
+        sizeShape[axis] = -1
+        netMeans[netIxs] = np.add.reduceat(x,startNodes[nonEmptyNets],axis=axis) / np.reshape(netSizes[nonEmptyNets],sizeShape)
+    else:
+        xValid = ~np.isnan(x)
+        netSums = np.add.reduceat(np.where(xValid,x,0),startNodes[nonEmptyNets],axis=axis)
+        netCounts = np.add.reduceat(xValid.astype(np.int32),startNodes[nonEmptyNets],axis=axis)
+        netMeans[netIxs] = netSums / netCounts
+    return netMeans
+
+def _subject_prefs(fcSubj,sortOrder,startNodes):
+    # One subject (tasks x nodes x nodes, contiguous): sort to the partition, take network means (NaNs skipped), then max/argmax over networks
+    fcSorted = fcSubj[:,sortOrder[:,None],sortOrder[None,:]]
+    clusteredTaskFC = _cluster_by_network(fcSorted,startNodes,axis=2) # task x node x network
+    return np.max(clusteredTaskFC,axis=2).T, np.argmax(clusteredTaskFC,axis=2).T
+
+def deviation(fcArray,netBoundaries,nodeOrder,useMeanFirst=False,useRestPartitionAdjuster=False,netBoundariesNew=None,nodeOrderNew=None,returnMaxMemberships=False,numThreads=1):
     '''
     INPUTS:
-    1. fcArray: a connectivity array of size: nodes x nodes x task conditions x subjects; do NOT sort to partition beforehand (this is handled by nodeOrder; plus possibly nodeOrderNew; see notes on these inputs below).
+    1. fcArray: a connectivity array of size: nodes x nodes x task conditions x subjects (computed in float32); do NOT sort to partition beforehand (this is handled by nodeOrder; plus possibly nodeOrderNew; see notes on these inputs below).
     2. netBoundaries: a helper variable that specifies information about the resting-state partition you'd like to use (Cocuzza et al., 2020 used the Cole Anticevic brain wide network partition, or CAB-NP (Ji et al., 2019); the helper variable included in this package boundariesCA.npy can be used here). It is of size: number of networks x 3. 1st column = start region index of network; 2nd column = end region index of network; 3rd column = network size. For example in the CAB-NP, VIS1 (or primary visual network) starts at region 0 and ends at region 5, so the first row of boundariesCA is: [0 5 6].
     3. nodeOrder: This is an indexing vector of size: number of nodes (should match first and second dimensions of fcArray). The values in this vector will "sort" the fcArray to the resting-state partition of interest (i.e., re-index). A helper variable is included in this package called nodeOrder.npy that can be used here. 
     4. useMeanFirst: optional. default is False; if True, this will take the mean across subjects first and all results will be in aggregate form (if False results will be returned for each subject)
     5. useRestPartitionAdjuster: optional. default is False; if True this will adjust the resting-state partition to empirical resting-state connectivity estimates(see Cocuzza et al., 2020 "empirically adjusted CABNP" in the Methods); also see helper function restPartitionAdjuster.py.
     6. netBoundariesNew: optional. default is None; if setting useRestPartitionAdjuster to True, this should be an array of the same format as netBoundaries, but adjusted based on empirical resting-state data (see Cocuzza et al., 2020 "empirically adjusted CABNP" in the Methods); also see helper function restPartitionAdjuster.py 
     7. nodeOrderNew: optional. default is None; if setting useRestPartitionAdjuster to True, this should be an array of the same format as nodeOrder, but adjusted based on empirical resting-state data (see Cocuzza et al., 2020 "empirically adjusted CABNP" in the Methods); also see helper function restPartitionAdjuster.py 
+    8. returnMaxMemberships: optional. default is False; if True the full binarized maxMembershipsTF array (see output 6) is built and returned. It is of size nodes x task conditions x networks x subjects, so it is left out by default to save memory (None is returned in its place).
+    9. numThreads: optional. default is 1; number of threads used to process subjects in parallel when useMeanFirst is False and numba is not installed (with numba the subject/task loop is already parallel). Each thread holds one subject's intermediate arrays, so memory use grows with numThreads.
     
     OUTPUTS:
     1. deviationRFs: an array of shape: number of networks x subjects. This is the main deviation result. Note: you can multiply by 100 to put it into percent form (i.e., percent of task states where a given node's connectivity deviated from the resting-state configuration). Note: 1-deviationRFs can give the complementary score of 'adherence', or how often (across task states) the resting-state configuration was adhered to.
@@ -33,8 +108,14 @@ def deviation(fcArray,netBoundaries,nodeOrder,useMeanFirst=False,useRestPartitio
     3. netAffinities: an array of shape: nodes x networks x subjects. for each region (node) and subject (e.g., netAffinities[region_index,:,subject_index]), a vector (of size: number of networks) of how often (how many task states) that region preferred a given network (i.e., clusteredAffinites at the region level).
     4. nodePrefVal: an array of size: nodes x task conditions. These are the maximum edge weights used to determine preferred connection per task condition (see Cocuzza et al., 2020). 
     5. nodePrefIdxs: an array of size: nodes x task conditions. If a region (node) deviates from it's resting-state configuration, this gives the network number that it reassigned to (for each task state)
-    6. maxMembershipsTF: an array of size: nodes x task conditions x networks x subjects. This is the full binarized array used to determine deviation scores. For a given region, subject, and task state (e.g., maxMembershipsTF[region_index,task_index,:,subject_index] which is a vector of size: number of networks) a 1 will will be in the prefferred network index. This relates to the output netAffinities in the following way: np.array_equal(netAffinities,(np.sum(maxMembershipsTF,axis=1) / number_conditions))
+    6. maxMembershipsTF: only returned if returnMaxMemberships=True (otherwise None). An array of size: nodes x task conditions x networks x subjects. This is the full binarized array used to determine deviation scores. For a given region, subject, and task state (e.g., maxMembershipsTF[region_index,task_index,:,subject_index] which is a vector of size: number of networks) a 1 will will be in the prefferred network index. This relates to the output netAffinities in the following way: np.array_equal(netAffinities,(np.sum(maxMembershipsTF,axis=1) / number_conditions))
     '''
+    nParcels = fcArray.shape[0]
+    numTasks = fcArray.shape[2]
+    numSubjs = fcArray.shape[3]
+    # Subjects-first (subjects x tasks x nodes x nodes) copy, so each subject's (and each task's) FC matrices are contiguous blocks
+    fcArray = np.ascontiguousarray(np.transpose(fcArray,(3,2,0,1)),dtype=np.float32)
+
     if useRestPartitionAdjuster:
         boundariesHere = netBoundariesNew.copy()
     elif not useRestPartitionAdjuster: 
@@ -42,87 +123,54 @@ def deviation(fcArray,netBoundaries,nodeOrder,useMeanFirst=False,useRestPartitio
         
     numNets = boundariesHere.shape[0]
 
-    nParcels = fcArray.shape[0]
-    numTasks = fcArray.shape[2]
-    numSubjs = fcArray.shape[3]
-        
+    # Network start/end (exclusive) node indices and sizes, cast once and reused below
+    startNodes = boundariesHere[:,0].astype(np.intp)
+    endNodes = (boundariesHere[:,1]+1).astype(np.intp)
+    netSizes = endNodes - startNodes
+    useNumba = (_clustered_prefs is not None) and (not useMeanFirst)
+
+    # Node order into the partition; composing the two re-indexings gives the same order as [nodeOrder,:][:,nodeOrder][nodeOrderNew,:][:,nodeOrderNew]
+    if useRestPartitionAdjuster:
+        print('Task FC: estimated with combinedFC & nodes sorted/clustered per empirically-adjusted CAB-NP')
+        sortOrder = np.asarray(nodeOrder)[nodeOrderNew].astype(np.intp)
+    elif not useRestPartitionAdjuster:
+        print('Task FC: estimated with combinedFC & nodes sorted/clustered per original CAB-NP')
+        sortOrder = np.asarray(nodeOrder).astype(np.intp)
+
     if useMeanFirst:
         # Cluster FC vals down to network-level (weighted avg) --> [node x network x task FC matrices]
+        # Sums/counts over subjects first (the leading, contiguous axis), then sort the task x node x node totals to the partition (one gather
+        # of rows & columns); networks are contiguous blocks of sorted nodes, so a segmented sum (reduceat) over the columns gives every
+        # network's total at once; NaNs are left out of both the sums and the counts (same as np.nanmean)
         print('Clustering FC values down to the network level (weighted average) --> node x network x task FC matrices...')
-        clusteredTaskFC = np.zeros((nParcels,numNets,numTasks))
-        tempNet = np.zeros((numNets))
-        tempTask = np.zeros((nParcels,numNets))
-        for ruleSet in range(numTasks):
-            if useRestPartitionAdjuster:
-                if ruleSet==0: 
-                    print('Task FC: estimated with combinedFC & nodes sorted/clustered per empirically-adjusted CAB-NP')
-                thisTaskHere = fcArray[:,:,ruleSet]
-                thisTask = thisTaskHere[nodeOrder,:][:,nodeOrder][nodeOrderNew,:][:,nodeOrderNew]
-            elif not useRestPartitionAdjuster:
-                if ruleSet==0: 
-                    print('Task FC: estimated with combinedFC & nodes sorted/clustered per original CAB-NP')
-                thisTaskHere = fcArray[:,:,ruleSet]
-                thisTask = thisTaskHere[nodeOrder,:][:,nodeOrder]
-            for nodeNum in range(nParcels):
-                thisNodeVec = thisTask[nodeNum,:]
-                for netNum in range(numNets):
-                    startNode = boundariesHere[netNum,0].astype(int)
-                    endNode = (boundariesHere[netNum,1]+1).astype(int)
-                    thisCluster = thisNodeVec[startNode:endNode]
-                    clusterMean = np.nanmean(thisCluster)
-                    tempNet[netNum] = clusterMean
-                tempTask[nodeNum,:] = tempNet
-            clusteredTaskFC[:,:,ruleSet] = tempTask
+        fcValid = ~np.isnan(fcArray)
+        fcSums = np.sum(np.where(fcValid,fcArray,0),axis=0)[:,sortOrder[:,None],sortOrder[None,:]]
+        fcCounts = np.sum(fcValid,axis=0,dtype=np.int32)[:,sortOrder[:,None],sortOrder[None,:]]
+        # Networks with no nodes are left out of the reduceat (it cannot take empty segments) and come out as NaN, as with np.nanmean
+        clusteredTaskFC = np.full((nParcels,numNets,numTasks),np.nan)
+        clusterSums = np.add.reduceat(fcSums,startNodes[netSizes>0],axis=2)
+        clusterCounts = np.add.reduceat(fcCounts,startNodes[netSizes>0],axis=2)
+        clusteredTaskFC[:,netSizes>0,:] = np.transpose(clusterSums / clusterCounts,(1,2,0)) # mean over network nodes and subjects; task x node x network --> node x network x task
 
         # Find max FC values and indices (e.g., connecting node number) of net means from above --> [node x task preference matrix]
         print('Finding max FC values and their indices (e.g., connecting node number) --> node x task preference matrices...');
-        tempNodeVecPrefs = np.zeros((nParcels))
-        nodePrefVals = np.zeros((nParcels,numTasks))
-        tempNodeVecIdxs = np.zeros((nParcels))
-        nodePrefIdxs = np.zeros((nParcels,numTasks))
-        for ruleSet in range(numTasks):
-            thisTask = clusteredTaskFC[:,:,ruleSet]
-            for nodeNum in range(nParcels):
-                thisNodeVec = thisTask[nodeNum,:]
-                maxVal = np.max(thisNodeVec)
-                maxIdx = np.argmax(thisNodeVec)
-                tempNodeVecPrefs[nodeNum] = maxVal
-                tempNodeVecIdxs[nodeNum] = maxIdx
-            nodePrefVals[:,ruleSet] = tempNodeVecPrefs
-            nodePrefIdxs[:,ruleSet] = tempNodeVecIdxs
+        nodePrefVals = np.max(clusteredTaskFC,axis=1)
+        nodePrefIdxs = np.argmax(clusteredTaskFC,axis=1).astype(float) # float, same as the per-subject branch
 
         # Iterating over all networks: test if preference index is a member of that network --> [node x task x network binarized affinity matrix]
         print('Iterating over all networks to test if the preference '+
               'index (ie max from above) is a member of that network --> node x task x network binarized affinity matrices...')
-        maxMembershipsTF = np.zeros((nParcels,numTasks,numNets))
-        maxMembershipsMean = np.zeros((nParcels,numTasks,numNets))
-        for nodeNum in range(nParcels):
-            thisNodeVec = nodePrefIdxs[nodeNum,:]
-            for netNum in range(numNets):
-                memberTF = (thisNodeVec==netNum)*1
-                maxMembershipsTF[nodeNum,:,netNum] = memberTF # kept binary
-                maxMembershipsMean[nodeNum,:,netNum] = memberTF * netNum # to get netIdx
+        maxMembershipsTF = np.eye(numNets,dtype=np.int8)[nodePrefIdxs.astype(np.intp)] # one-hot of preferred network index; kept binary
 
         # Find affinity scores (relative frequencies or RFs) for all connecting networks --> [node x network relative freq NPA values]
         print('Finding affinity scores (relative frequencies) for all connecting networks --> node x network x relative frequency NPA matrices...')
-        netAffinities = np.zeros((nParcels,numNets))
-        for netNum in range(numNets):
-            thisNet = maxMembershipsTF[:,:,netNum]
-            for nodeNum in range(nParcels):
-                thisNodeVec = thisNet[nodeNum,:]
-                thisNodeSum = np.sum(thisNodeVec)
-                thisNodeRF = thisNodeSum / numTasks # Tally --> RF
-                netAffinities[nodeNum,netNum] = thisNodeRF # Each row should add to 1 with np.sum(netAffinities,axis=1)
+        netAffinities = np.sum(maxMembershipsTF,axis=1) / numTasks # Tally --> RF; each row should add to 1 with np.sum(netAffinities,axis=1)
+        if not returnMaxMemberships:
+            maxMembershipsTF = None
 
         # Cluster ROIs into NOIs --> [network x network relative frequency NPA values]
         print('Clustering ROIs into NOIs --> network x network relative frequency NPA matrices...')
-        clusteredAffinities = np.zeros((numNets,numNets))
-        for netNum in range(numNets):
-            startNode = boundariesHere[netNum,0].astype(int)
-            endNode = (boundariesHere[netNum,1]+1).astype(int)
-            thisCluster = netAffinities[startNode:endNode,:]
-            clusterMeanRFs = np.nanmean(thisCluster,axis=0) # should still add to 1 per row
-            clusteredAffinities[netNum,:] = clusterMeanRFs
+        clusteredAffinities = _cluster_by_network(netAffinities,startNodes,netSizes) # should still add to 1 per row
 
         # Sanity check: they all add to 100% 
         print('Sanity check that all clustered affinities add to 100%...');
@@ -143,88 +191,43 @@ def deviation(fcArray,netBoundaries,nodeOrder,useMeanFirst=False,useRestPartitio
 
     ##################################################################################################################
     elif not useMeanFirst:
-        # Cluster FC vals down to network-level (weighted avg) --> [node x network x task FC matrices]
-        print('Clustering FC values down to the network level (weighted average) --> node x network x task x subject FC matrices...')
-        clusteredTaskFC = np.zeros((nParcels,numNets,numTasks,numSubjs))
-        tempNet = np.zeros((numNets))
-        tempTask = np.zeros((nParcels,numNets))
-        for subjNum in range(numSubjs):
-            for taskNum in range(numTasks):
-                if useRestPartitionAdjuster:
-                    if taskNum==0 and subjNum==0: 
-                        print('Task FC: estimated with combinedFC & nodes sorted/clustered per empirically-adjusted CAB-NP')
-                    thisTaskHere = fcArray[:,:,taskNum,subjNum]
-                    thisTask = thisTaskHere[nodeOrder,:][:,nodeOrder][nodeOrderNew,:][:,nodeOrderNew]
-                elif not useRestPartitionAdjuster:
-                    if taskNum==0 and subjNum==0: 
-                        print('Task FC: estimated with combinedFC & nodes sorted/clustered per original CAB-NP')
-                    thisTaskHere = fcArray[:,:,taskNum,subjNum]
-                    thisTask = thisTaskHere[nodeOrder,:][:,nodeOrder]
-                for nodeNum in range(nParcels):
-                    thisNodeVec = thisTask[nodeNum,:]
-                    for netNum in range(numNets):
-                        startNode = boundariesHere[netNum,0].astype(int)
-                        endNode = (boundariesHere[netNum,1]+1).astype(int)
-                        thisCluster = thisNodeVec[startNode:endNode]
-                        clusterMean = np.nanmean(thisCluster)
-                        tempNet[netNum] = clusterMean
-                    tempTask[nodeNum,:] = tempNet
-                clusteredTaskFC[:,:,taskNum,subjNum] = tempTask
-
-        # Find max FC values and indices (e.g., connecting node number) of net means from above --> [node x task preference matrix]
-        print('Finding max FC values and their indices (e.g., connecting node number) --> node x task x subject preference matrices...')
-        tempNodeVecPrefs = np.zeros((nParcels))
-        nodePrefVals = np.zeros((nParcels,numTasks,numSubjs))
-        tempNodeVecIdxs = np.zeros((nParcels))
-        nodePrefIdxs = np.zeros((nParcels,numTasks,numSubjs))
-        for subjNum in range(numSubjs):
-            for taskNum in range(numTasks):
-                thisTask = clusteredTaskFC[:,:,taskNum,subjNum]
-                for nodeNum in range(nParcels):
-                    thisNodeVec = thisTask[nodeNum,:]
-                    maxVal = np.max(thisNodeVec)
-                    maxIdx = np.argmax(thisNodeVec)
-                    tempNodeVecPrefs[nodeNum] = maxVal
-                    tempNodeVecIdxs[nodeNum] = maxIdx
-                nodePrefVals[:,taskNum,subjNum] = tempNodeVecPrefs
-                nodePrefIdxs[:,taskNum,subjNum] = tempNodeVecIdxs
-
-        # Iterating over all networks: test if preference index is a member of that network --> [node x task x network binarized affinity matrix]
-        print('Iterating over all networks to test if the preference index '+
-              '(ie max from above) is a member of that network --> node x task x network x subject binarized affinity matrices...')
-        maxMembershipsTF = np.zeros((nParcels,numTasks,numNets,numSubjs))
-        maxMembershipsMean = np.zeros((nParcels,numTasks,numNets,numSubjs))
-        for subjNum in range(numSubjs):
-            for nodeNum in range(nParcels):
-                thisNodeVec = nodePrefIdxs[nodeNum,:,subjNum]
-                for netNum in range(numNets):
-                    memberTF = (thisNodeVec==netNum)*1
-                    maxMembershipsTF[nodeNum,:,netNum,subjNum] = memberTF # kept binary
-                    maxMembershipsMean[nodeNum,:,netNum,subjNum] = memberTF * netNum # to get netIdx
+        if useNumba:
+            # Cluster + find max FC values in one pass over fcArray; the sorted/clustered FC arrays are never built
+            print('Clustering FC values down to the network level (weighted average) and finding max FC values and their indices '+
+                  '(numba) --> node x task x subject preference matrices...')
+            nodePrefVals, nodePrefIdxs = _clustered_prefs(fcArray,sortOrder,startNodes,endNodes)
+        else:
+            # Cluster FC vals down to network-level (weighted avg) and find max FC values and indices, one subject at a time
+            # (only a single subject's sorted/clustered FC arrays are held in memory) --> [node x task x subject preference matrices]
+            print('Clustering FC values down to the network level (weighted average) and finding max FC values and their indices '+
+                  '(per subject) --> node x task x subject preference matrices...')
+            nodePrefVals = np.zeros((nParcels,numTasks,numSubjs),dtype=np.float32)
+            nodePrefIdxs = np.zeros((nParcels,numTasks,numSubjs))
+            with ThreadPoolExecutor(max_workers=numThreads) as executor:
+                subjPrefs = executor.map(lambda subjNum: _subject_prefs(fcArray[subjNum],sortOrder,startNodes),range(numSubjs))
+                for subjNum,(subjPrefVals,subjPrefIdxs) in enumerate(subjPrefs):
+                    nodePrefVals[:,:,subjNum] = subjPrefVals
+                    nodePrefIdxs[:,:,subjNum] = subjPrefIdxs
 
         # Find affinity scores (relative frequencies or RFs) for all connecting networks --> [node x network relative freq NPA values]
+        # Tallies preferred networks across tasks directly (bincount), so the binarized membership array is only built if requested
         print('Finding affinity scores (relative frequencies) for all connecting networks --> node x network x relative frequency NPA matrices...')
-        netAffinities = np.zeros((nParcels,numNets,numSubjs))
-        for subjNum in range(numSubjs):
-            for netNum in range(numNets):
-                thisNet = maxMembershipsTF[:,:,netNum,subjNum]
-                for nodeNum in range(nParcels):
-                    thisNodeVec = thisNet[nodeNum,:]
-                    thisNodeSum = np.sum(thisNodeVec)
-                    thisNodeRF = thisNodeSum / numTasks # Tally --> RF
-                    netAffinities[nodeNum,netNum,subjNum] = thisNodeRF # Each row should add to 1 with np.sum(netAffinities,axis=1)
+        prefIdxs = nodePrefIdxs.astype(np.intp)
+        tallyIxs = ((np.arange(nParcels)[:,None,None]*numNets + prefIdxs)*numSubjs) + np.arange(numSubjs)[None,None,:]
+        netAffinities = np.bincount(tallyIxs.ravel(),minlength=nParcels*numNets*numSubjs).reshape((nParcels,numNets,numSubjs))
+        netAffinities = netAffinities / numTasks # Tally --> RF; each row should add to 1 with np.sum(netAffinities,axis=1)
+
+        if returnMaxMemberships:
+            # Iterating over all networks: test if preference index is a member of that network --> [node x task x network binarized affinity matrix]
+            print('Building binarized membership (preference index is a member of a given network) --> node x task x network x subject binarized affinity matrices...')
+            maxMembershipsTF = np.eye(numNets,dtype=np.int8)[prefIdxs] # one-hot of preferred network index; kept binary
+            maxMembershipsTF = np.moveaxis(maxMembershipsTF,-1,2) # node x task x subject x network --> node x task x network x subject
+        else:
+            maxMembershipsTF = None
 
         # Cluster ROIs into NOIs --> [network x network relative frequency NPA values]
         print('Clustering ROIs into NOIs --> network x network x subject relative frequency NPA matrices...')
-        clusteredAffinities = np.zeros((numNets,numNets,numSubjs))
-        for subjNum in range(numSubjs):
-            thisSubj = netAffinities[:,:,subjNum]
-            for netNum in range(numNets):
-                startNode = boundariesHere[netNum,0].astype(int)
-                endNode = (boundariesHere[netNum,1]+1).astype(int)
-                thisCluster = thisSubj[startNode:endNode,:]
-                clusterMeanRFs = np.nanmean(thisCluster,axis=0) # should still add to 1 per row
-                clusteredAffinities[netNum,:,subjNum] = clusterMeanRFs 
+        clusteredAffinities = _cluster_by_network(netAffinities,startNodes,netSizes) # should still add to 1 per row
 
         # Sanity check: they all add to 100% 
         print('Sanity check that all clustered affinities add to 100%...');
@@ -237,9 +240,7 @@ def deviation(fcArray,netBoundaries,nodeOrder,useMeanFirst=False,useRestPartitio
 
         # Pulling out adherence to pre-defined network partition --> [network x 1] NPA vector 
         print('Pulling out adherence to pre-defined network partition --> network x subject NPA matrices...')
-        adherenceRFs = np.zeros((numNets,numSubjs))
-        for subjNum in range(numSubjs):
-            adherenceRFs[:,subjNum] = np.diag(clusteredAffinities[:,:,subjNum])
+        adherenceRFs = np.einsum('iis->is',clusteredAffinities) # diagonal of every subject's network x network matrix --> network x subject
 
         # Calculating deviation (NPD) as 1-NPA --> [network x 1] NPD vector 
         print('Computing deviation (NPD) --> network x subject NPD matrices...')
@@ -2,31 +2,75 @@
 # global variability coefficient (GVC), a measure of flexible hubs.
 
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 
-def gvc(fcArray):
+try:
+    import cupy
+except ImportError: # cupy is optional; only needed for backend='cupy' (GPU)
+    cupy = None
+
+def _gvc_chunk(fcChunk,xp):
+    # GVC (subjects in chunk x nodes) for one chunk of subjects (subjects in chunk x task conditions x nodes x nodes), computed with xp (numpy or cupy)
+    numTasks = fcChunk.shape[1]
+    nParcels = fcChunk.shape[2]
+    diagIxs = xp.arange(nParcels)
+    
+    # population std across task states from the 1st and 2nd moments (both accumulated with einsum, no nanstd pass)
+    meanAcrossTasks = xp.einsum('stij->sij',fcChunk) / numTasks
+    meanSqAcrossTasks = xp.einsum('stij,stij->sij',fcChunk,fcChunk) / numTasks
+    stdAcrossTasks = xp.sqrt(xp.maximum(meanSqAcrossTasks - (meanAcrossTasks * meanAcrossTasks),0))
+    stdAcrossTasks[:,diagIxs,diagIxs] = 0 # self-connections are left out of the mean across connecting nodes below
+    
+    if bool(xp.isnan(stdAcrossTasks).any()):
+        # missing (NaN) edges off the diagonal: use the NaN-aware estimate instead
+        fcNoDiag = fcChunk.copy() # copy so the caller's array is left as-is
+        fcNoDiag[:,:,diagIxs,diagIxs] = xp.nan
+        return xp.nanmean(xp.nanstd(fcNoDiag,axis=1),axis=2) # variability across states --> mean of connecting nodes 
+    return xp.sum(stdAcrossTasks,axis=2) / (nParcels-1) # variability across states --> mean of connecting nodes 
+
+def gvc(fcArray,backend='numpy',subjsPerChunk=None,numThreads=1):
     '''
     INPUTS:
-    fcArray: a connectivity array of size: nodes x nodes x task conditions x subjects 
+    fcArray: a connectivity array of size: nodes x nodes x task conditions x subjects (computed in float32)
+    backend: optional. default is 'numpy'; if 'cupy' GVC is computed on the GPU with cupy (must be installed). Results are returned as numpy arrays either way.
+    subjsPerChunk: optional. default is None (all subjects at once, or split evenly over numThreads); number of subjects to send through at a time, e.g., to fit fcArray into GPU memory with backend='cupy'.
+    numThreads: optional. default is 1; number of threads used to process subject chunks in parallel (backend='numpy' only). Each thread holds one chunk's intermediate arrays, so memory use grows with numThreads.
     
     OUTPUTS:
-    gvcNodesSubjs: an array of GVC scores of size: nodes x subjects. Each parent (row) node from fcArray has a GVC score, which per target node, is the standard deviation of each of it's source (column) nodes connectivity weights across task conditions, which is then averaged across source nodes to get 1 score. 
+    gvcNodesSubjs: an array of GVC scores (float32) of size: nodes x subjects. Each parent (row) node from fcArray has a GVC score, which per target node, is the standard deviation of each of it's source (column) nodes connectivity weights across task conditions, which is then averaged across source nodes to get 1 score. 
     
     '''
     
+    if backend=='cupy':
+        if cupy is None:
+            raise ImportError("backend='cupy' requires cupy (https://cupy.dev) to be installed")
+        xp = cupy
+    elif backend=='numpy':
+        xp = np
+    else:
+        raise ValueError("backend should be either 'numpy' or 'cupy', not " + str(backend))
+    
     nParcels = fcArray.shape[0]
-    numTasks = fcArray.shape[2]
     numSubjs = fcArray.shape[3]
+    # Subjects-first (subjects x tasks x nodes x nodes) copy, so each chunk of subjects is 1 contiguous block
+    fcArray = np.ascontiguousarray(np.transpose(fcArray,(3,2,0,1)),dtype=np.float32)
+    if backend=='cupy':
+        numThreads = 1 # chunks are already run in parallel on the GPU
+    if subjsPerChunk is None:
+        subjsPerChunk = -(-numSubjs // numThreads) # ceil; 1 chunk per thread
     
     # Compute GVC 
-    gvcNodesSubjs = np.zeros((nParcels,numSubjs))
-    tempSubj = np.zeros((nParcels,nParcels,numTasks))
-    for subjNum in range(numSubjs):
-        thisSubj = fcArray[:,:,:,subjNum]
-        for taskNum in range(numTasks): 
-            thisTask = thisSubj[:,:,taskNum]
-            np.fill_diagonal(thisTask,np.nan)
-            tempSubj[:,:,taskNum] = thisTask
-
-        gvcNodesSubjs[:,subjNum] = np.nanmean(np.nanstd(tempSubj,axis=2),axis=1) # variability across states --> mean of connecting nodes 
+    def gvcOneChunk(startSubj):
+        fcChunk = xp.asarray(fcArray[startSubj:startSubj+subjsPerChunk]) # host --> device copy when backend='cupy'
+        gvcChunk = _gvc_chunk(fcChunk,xp)
+        if backend=='cupy':
+            gvcChunk = cupy.asnumpy(gvcChunk) # device --> host
+        return gvcChunk
+    
+    gvcNodesSubjs = np.zeros((nParcels,numSubjs),dtype=np.float32)
+    chunkStarts = range(0,numSubjs,subjsPerChunk)
+    with ThreadPoolExecutor(max_workers=numThreads) as executor:
+        for startSubj,gvcChunk in zip(chunkStarts,executor.map(gvcOneChunk,chunkStarts)):
+            gvcNodesSubjs[:,startSubj:startSubj+subjsPerChunk] = gvcChunk.T
             
-    return gvcNodesSubjs
\ No newline at end of file
+    return gvcNodesSubjs
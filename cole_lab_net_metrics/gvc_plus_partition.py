@@ -6,10 +6,32 @@
 
 import numpy as np
 
+def _cluster_by_network(x,startNodes,netSizes=None,axis=0):
+    # Mean over each network's nodes along axis: networks are contiguous blocks of sorted nodes, so one segmented sum (reduceat) covers all networks.
+    # If netSizes is given, x is taken to be NaN-free and sums are divided by network sizes; otherwise NaNs are left out of both the sums and
+    # the counts (same as np.nanmean per network). Same copy in deviation.py; keep the two in sync
+    # Networks with no nodes (e.g., a [k, k-1, 0] row from restPartitionAdjuster) come out as NaN; they are left out of the reduceat, which
+    # cannot take empty segments
+    nonEmptyNets = np.diff(np.append(startNodes,x.shape[axis]))>0
+    netIxs = (slice(None),)*axis + (nonEmptyNets,)
+    outShape = list(x.shape)
+    outShape[axis] = len(startNodes)
+    netMeans = np.full(outShape,np.nan)
+    if netSizes is not None:
+        sizeShape = [1] * x.ndim
+        sizeShape[axis] = -1
+        netMeans[netIxs] = np.add.reduceat(x,startNodes[nonEmptyNets],axis=axis) / np.reshape(netSizes[nonEmptyNets],sizeShape)
+    else:
+        xValid = ~np.isnan(x)
+        netSums = np.add.reduceat(np.where(xValid,x,0),startNodes[nonEmptyNets],axis=axis)
+        netCounts = np.add.reduceat(xValid.astype(np.int32),startNodes[nonEmptyNets],axis=axis)
+        netMeans[netIxs] = netSums / netCounts
+    return netMeans
+
 def gvc(fcArray,netBoundaries,nodeOrder,useRestPartitionAdjuster=False,netBoundariesNew=None,nodeOrderNew=None):
     '''
         INPUTS:
-    1. fcArray: a connectivity array of size: nodes x nodes x task conditions x subjects; do NOT sort to partition beforehand (this is handled by nodeOrder; plus possibly nodeOrderNew; see notes on these inputs below).
+    1. fcArray: a connectivity array of size: nodes x nodes x task conditions x subjects (computed in float32); do NOT sort to partition beforehand (this is handled by nodeOrder; plus possibly nodeOrderNew; see notes on these inputs below).
     2. netBoundaries: a helper variable that specifies information about the resting-state partition you'd like to use (Cocuzza et al., 2020 used the Cole Anticevic brain wide network partition, or CAB-NP; the helper variable included in this package boundariesCA.npy can be used here). It is of size: number of networks x 3. 1st column = start region index of network; 2nd column = end region index of network; 3rd column = network size. For example in te CAB-NP, VIS1 (or primary visual network) starts at region 0 and ends at region 5, so the first row of boundariesCA is: [0 5 6].
     3. nodeOrder: This is an indexing vector of size: number of nodes (should match first and second dimensions of fcArray). The values in this vector will "sort" the fcArray to the resting-state partition of interest (i.e., re-index). A helper variable is included in this packaged called nodeOrder.npy that can be used here. 
     4. useRestPartitionAdjuster: optional. default is False; if True 
@@ -17,7 +39,7 @@ def gvc(fcArray,netBoundaries,nodeOrder,useRestPartitionAdjuster=False,netBounda
     6. nodeOrderNew: optional. default is None; if setting useRestPartitionAdjuster to True, this should be an array of the same format as nodeOrder, but adjusted based on empirical resting-state data (see Cocuzza et al., 2020 "empirically adjusted CABNP" in the Methods); also see helper function restPartitionAdjuster.py 
     
     OUTPUTS:
-    gvcNodesSubjs: an array of GVC scores of size: nodes x subjects. Each parent (row) node from fcArray has a GVC score, which per target node, is the standard deviation of each of it's source (column) nodes connectivity weights across task conditions, which is then averaged across source nodes to get 1 score. the same result as gvc.py
+    gvcNodesSubjs: an array of GVC scores (float32) of size: nodes x subjects. Each parent (row) node from fcArray has a GVC score, which per target node, is the standard deviation of each of it's source (column) nodes connectivity weights across task conditions, which is then averaged across source nodes to get 1 score. the same result as gvc.py
     gvcNetsSubjs: an array of GVC scores of size: networks x subjects. Same as gvcNodesSubjs, but regions (nodes) are clustered into their corresponding functional networks. Each row contains mean GVC scores of all the regions in that network (per subject).
     gvcNodes: a vector of GVC scores of size: number of nodes. This is the grand mean GVC for each region (i.e., just the mean across subjects of gvcNodesSubjs).
     '''
@@ -26,24 +48,25 @@ def gvc(fcArray,netBoundaries,nodeOrder,useRestPartitionAdjuster=False,netBounda
         boundariesHere = netBoundariesNew.copy()
     elif not useRestPartitionAdjuster: 
         boundariesHere = netBoundaries.copy()
-        
-    numNets = boundariesHere.shape[0]
 
+    fcArray = np.ascontiguousarray(fcArray,dtype=np.float32)
     nParcels = fcArray.shape[0]
     numTasks = fcArray.shape[2]
-    numSubjs = fcArray.shape[3]
     
-    # Compute GVC 
-    gvcNodesSubjs = np.zeros((nParcels,numSubjs))
-    tempSubj = np.zeros((nParcels,nParcels,numTasks))
-    for subjNum in range(numSubjs):
-        thisSubj = fcArray[:,:,:,subjNum]
-        for taskNum in range(numTasks): # the purpose of this loop is just to fill in the diagonals with NaNs (may be a better way to do this)
-            thisTask = thisSubj[:,:,taskNum]
-            np.fill_diagonal(thisTask,np.nan)
-            tempSubj[:,:,taskNum] = thisTask
-
-        gvcNodesSubjs[:,subjNum] = np.nanmean(np.nanstd(tempSubj,axis=2),axis=1) # variability across states --> mean of connecting nodes 
+    # Compute GVC: population std across task states from the 1st and 2nd moments (1 pass each with einsum; no nanstd, no centered copy of fcArray)
+    meanAcrossTasks = np.einsum('ijts->ijs',fcArray) / numTasks
+    meanSqAcrossTasks = np.einsum('ijts,ijts->ijs',fcArray,fcArray) / numTasks
+    stdAcrossTasks = np.sqrt(np.maximum(meanSqAcrossTasks - (meanAcrossTasks * meanAcrossTasks),0))
+    diagIxs = np.arange(nParcels)
+    stdAcrossTasks[diagIxs,diagIxs,:] = 0 # self-connections are left out of the mean across connecting nodes below
+    
+    if np.isnan(stdAcrossTasks).any():
+        # missing (NaN) edges off the diagonal: use the NaN-aware estimate instead
+        diagMask = np.eye(nParcels,dtype=bool)[:,:,None,None] # broadcasts over tasks and subjects
+        fcMasked = np.where(diagMask,np.nan,fcArray) # diagonals --> NaN for all tasks/subjects at once (new array; fcArray is left as-is)
+        gvcNodesSubjs = np.nanmean(np.nanstd(fcMasked,axis=2),axis=1) # variability across states --> mean of connecting nodes 
+    else:
+        gvcNodesSubjs = np.sum(stdAcrossTasks,axis=1) / (nParcels-1) # variability across states --> mean of connecting nodes 
 
     if useRestPartitionAdjuster:
         gvcNodesSubjs = gvcNodesSubjs[nodeOrder,:][nodeOrderNew,:]
@@ -52,14 +75,8 @@ def gvc(fcArray,netBoundaries,nodeOrder,useRestPartitionAdjuster=False,netBounda
 
     gvcNodes = np.nanmean(gvcNodesSubjs,axis=1)
 
-    # Cluster into networks 
-    gvcNetsSubjs = np.zeros((numNets,numSubjs))
-    for subjNum in range(numSubjs):
-        thisSubj = gvcNodesSubjs[:,subjNum]
-        for netNum in range(numNets):
-            startNode = boundariesHere[netNum,0].astype(int)
-            endNode = (boundariesHere[netNum,1]+1).astype(int)
-            thisCluster = thisSubj[startNode:endNode]
-            gvcNetsSubjs[netNum,subjNum] = np.nanmean(thisCluster)
+    # Cluster into networks (mean of each network's nodes, NaNs skipped) for all subjects at once
+    startNodes = boundariesHere[:,0].astype(int)
+    gvcNetsSubjs = _cluster_by_network(gvcNodesSubjs,startNodes)
             
     return gvcNodesSubjs, gvcNetsSubjs, gvcNodes
@@ -1,76 +1,148 @@
 # C. Cocuzza, 2022. Based on Cocuzza et al., 2020, J Neurosci.
 
 import numpy as np
-import scipy.stats as stats
+from concurrent.futures import ThreadPoolExecutor
 
-def restPartitionAdjuster(fcArray,netBoundaries,nodeOrder):
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+
+if njit is not None:
+    @njit(parallel=True)
+    def _rest_prefs(fcArray,sortOrder,startNodes,endNodes):
+        # Fused sort --> Fisher z --> network mean (self-connections & NaNs skipped, as in np.nanmean) --> tanh --> argmax, read straight from the unsorted fcArray.
+        # Subjects are the innermost loop, so each edge's values for all subjects are read as 1 contiguous stripe (last axis of fcArray)
+        nParcels = fcArray.shape[0]
+        numSubjs = fcArray.shape[2]
+        numNets = startNodes.shape[0]
+        restPreferences = np.zeros((nParcels,numSubjs),dtype=np.int16)
+        for nodeNum in prange(nParcels):
+            rowIx = sortOrder[nodeNum]
+            maxVals = np.full(numSubjs,-np.inf)
+            maxIdxs = np.zeros(numSubjs,dtype=np.int16)
+            foundNaN = np.zeros(numSubjs,dtype=np.bool_)
+            zSums = np.zeros(numSubjs)
+            zCounts = np.zeros(numSubjs)
+            for netNum in range(numNets):
+                zSums[:] = 0.0
+                zCounts[:] = 0.0
+                for colNum in range(startNodes[netNum],endNodes[netNum]):
+                    if colNum == nodeNum:
+                        continue
+                    colIx = sortOrder[colNum]
+                    for subjNum in range(numSubjs):
+                        zVal = np.arctanh(fcArray[rowIx,colIx,subjNum])
+                        if not np.isnan(zVal):
+                            zSums[subjNum] += zVal
+                            zCounts[subjNum] += 1
+                for subjNum in range(numSubjs):
+                    if foundNaN[subjNum]: # np.argmax stops at the first NaN
+                        continue
+                    netMean = np.tanh(zSums[subjNum] / zCounts[subjNum]) if zCounts[subjNum] > 0 else np.nan
+                    if np.isnan(netMean):
+                        foundNaN[subjNum] = True
+                        maxIdxs[subjNum] = netNum
+                    elif netMean > maxVals[subjNum]:
+                        maxVals[subjNum] = netMean
+                        maxIdxs[subjNum] = netNum
+            restPreferences[nodeNum,:] = maxIdxs
+        return restPreferences
+else:
+    _rest_prefs = None
+
+def _subject_prefs(fcSubjs,sortOrder,startNodes,endNodes):
+    # Preferred network per node for a chunk of subjects (nodes x nodes x subjects in chunk): sort, Fisher z, network means, tanh, argmax
+    nParcels = fcSubjs.shape[0]
+    # Sort the chunk's FC to the partition at once (1 gather of rows & columns) and take Fisher z once
+    sortedZ = fcSubjs[np.ix_(sortOrder,sortOrder)] # nodes x nodes x subjects (new array; fcArray is left as-is)
+    diagIxs = np.arange(nParcels)
+    sortedZ[diagIxs,diagIxs,:] = 0 # self-connections --> 0 before the Fisher z (so no arctanh(1) = inf); they add nothing to the sums, and are taken out of the counts below
+    np.arctanh(sortedZ,out=sortedZ) # in place: no 2nd full-size temporary
+    
+    # Each node's mean z per network for all subjects: networks are contiguous blocks of sorted nodes, so a segmented sum (reduceat) covers all networks.
+    # Networks with no nodes (e.g., a [k, k-1, 0] row) are left out of the reduceat, which cannot take empty segments, and come out as NaN
+    nonEmptyNets = endNodes > startNodes
+    netStarts = startNodes[nonEmptyNets]
+    if not np.isnan(sortedZ).any():
+        # no missing edges: plain sums, and counts = network size (- 1 for the node's own network, as its self-connection is left out)
+        zSums = np.add.reduceat(sortedZ,netStarts,axis=1)
+        ownNetTF = (diagIxs[:,None]>=netStarts[None,:]) & (diagIxs[:,None]<endNodes[nonEmptyNets][None,:]) # nodes x networks
+        zCounts = ((endNodes-startNodes)[nonEmptyNets][None,:] - ownNetTF)[:,:,None]
+    else:
+        # missing (NaN) edges: NaNs (and self-connections) are left out of both the sums and the counts, as in np.nanmean
+        sortedZ[diagIxs,diagIxs,:] = np.nan
+        zValid = ~np.isnan(sortedZ)
+        zSums = np.add.reduceat(np.where(zValid,sortedZ,0),netStarts,axis=1)
+        zCounts = np.add.reduceat(zValid.astype(int),netStarts,axis=1)
+    np.divide(zSums,zCounts,out=zSums) # in place, as is the tanh
+    np.tanh(zSums,out=zSums)
+    netMeansFC = np.full((nParcels,len(startNodes),sortedZ.shape[2]),np.nan,dtype=zSums.dtype) # nodes x networks x subjects
+    netMeansFC[:,nonEmptyNets,:] = zSums
+
+    return np.argmax(netMeansFC,axis=1) # nodes x subjects; preferred (max mean FC) network index
+
+def restPartitionAdjuster(fcArray,netBoundaries,nodeOrder,numThreads=1):
     '''
     INPUTS:
-    1. fcArray: a resting-state (or otherwise intrinsic) connectivity array of size: nodes x nodes x subjects; do NOT sort to partition beforehand (this is handled by nodeOrder)
+    1. fcArray: a resting-state (or otherwise intrinsic) connectivity array of size: nodes x nodes x subjects (computed in float32); do NOT sort to partition beforehand (this is handled by nodeOrder)
     2. netBoundaries: a helper variable that specifies information about the original resting-state partition that is to be adjusted (Cocuzza et al., 2020 used the Cole Anticevic brain wide network partition, or CAB-NP (Ji et al., 2019); the helper variable included in this package boundariesCA.npy can be used here). It is of size: number of networks x 3. 1st column = start region index of network; 2nd column = end region index of network; 3rd column = network size. For example in the CAB-NP, VIS1 (or primary visual network) starts at region 0 and ends at region 5, so the first row of boundariesCA is: [0 5 6].
     3. nodeOrder: This is an indexing vector of size: number of nodes (should match first and second dimensions of fcArray). The values in this vector will "sort" the fcArray to the original resting-state partition of interest (i.e., re-index). A helper variable is included in this package called nodeOrder.npy that can be used here. 
+    4. numThreads: optional. default is 1; number of threads used to process chunks of subjects in parallel when numba is not installed (with numba the node loop is already parallel). Each thread holds one chunk's intermediate arrays.
     
     OUTPUTS:
-    1. netBoundariesNew: an array of size: networks x 3. This is the same format as netBoundaries, but with the adjustment made based on empirical resting-state FC estimates. This can be used in deviation.py and gvc_plus_partition.py.
+    1. netBoundariesNew: an array of size: networks x 3. This is the same format as netBoundaries, but with the adjustment made based on empirical resting-state FC estimates. This can be used in deviation.py and gvc_plus_partition.py. A network left with no nodes gets the row [k, k-1, 0] (k = the next network's start), and comes out as NaN in those modules.
     2. nodeOrderNew: an array of size: number of nodes (ie regions). This is the same format as nodeOrder, but with the adjustment made based on empirical resting-state FC estimates. This can be used in deviation.py and gvc_plus_partition.py.
-    3. restPreferences: an array of size: nodes x subjects. For each region (node) and subject, the number indicates network index that is preferred. 
+    3. restPreferences: an array (int16) of size: nodes x subjects. For each region (node) and subject, the number indicates network index that is preferred. 
     4. percentAgree: an array of size: number of nodes (ie regions). For each region (node) this is the percent (in decimal format) of subjects that lead to the consensus. 
     5. restConsensus: an array of size: number of nodes (ie regions). For each region (node) this is the preferred network index (cross-subject consensus with percentAgree agreement).
     6. nodeIndicesNew: an array of size: number of nodes (ie regions). This is the adjusted network affiliation vector (each region's network number).
     '''
     
+    fcArray = np.ascontiguousarray(fcArray,dtype=np.float32)
     nParcels = fcArray.shape[0]
     numSubjs = fcArray.shape[2]
     
     numNets = netBoundaries.shape[0]
     
-    restPreferences = np.zeros((nParcels,numSubjs))
-    for subjNum in range(numSubjs):
-        thisSubjRestFC = fcArray[:,:,subjNum].copy()
-        subjSortedCA = thisSubjRestFC[nodeOrder,:][:,nodeOrder]
-        np.fill_diagonal(subjSortedCA,np.nan)
-        
-        for nodeNum in range(nParcels):
-            thisNodeVec = subjSortedCA[nodeNum,:]
-            tempVec = np.zeros((numNets))
-            
-            for netNum in range(numNets):
-                startNode = netBoundaries[netNum,0].astype(int)
-                endNode = (netBoundaries[netNum,1]+1).astype(int)
-                tempVec[netNum] = np.tanh(np.nanmean(np.arctanh(thisNodeVec[startNode:endNode])))
-                
-            prefIdx = np.argsort(tempVec)[::-1]
-            prefVals = np.sort(tempVec)[::-1] # 0 index should equal np.max(tempVec); note [::-1] puts it in descending order (flips array)
-            restPreferences[nodeNum,subjNum] = prefIdx[0]
+    # Network start/end (exclusive) node indices, cast once and reused below
+    startNodes = netBoundaries[:,0].astype(np.intp)
+    endNodes = (netBoundaries[:,1]+1).astype(np.intp)
+    
+    if _rest_prefs is not None:
+        # numba: preferred network per node & subject in 1 parallel pass; the sorted/Fisher z arrays are never built
+        restPreferences = _rest_prefs(fcArray,np.asarray(nodeOrder).astype(np.intp),startNodes,endNodes)
+    else:
+        sortOrder = np.asarray(nodeOrder).astype(np.intp)
+        subjsPerChunk = -(-numSubjs // numThreads) # ceil; 1 chunk per thread
+        chunkStarts = range(0,numSubjs,subjsPerChunk)
+        restPreferences = np.zeros((nParcels,numSubjs),dtype=np.int16)
+        with ThreadPoolExecutor(max_workers=numThreads) as executor:
+            chunkPrefs = executor.map(lambda startSubj: _subject_prefs(fcArray[:,:,startSubj:startSubj+subjsPerChunk],sortOrder,startNodes,endNodes),chunkStarts)
+            for startSubj,subjPrefs in zip(chunkStarts,chunkPrefs):
+                restPreferences[:,startSubj:startSubj+subjsPerChunk] = subjPrefs
 
     # find consensus: if 50% or more of subjects have this preference 
-    restMode, restModeCount = stats.mode(restPreferences,axis=1)
-    percentAgree = np.zeros((nParcels))
-    for nodeNum in range(nParcels):
-        thisMode = restMode[nodeNum].astype(int)[0]
-        percentAgree[nodeNum] = (restModeCount[nodeNum].astype(int)[0])/numSubjs
+    # Tally each node's preferred networks across subjects (bincount over node x network bins); the mode is the most frequent network 
+    # (ties --> lowest network index, as with scipy.stats.mode)
+    prefCounts = np.bincount((np.arange(nParcels)[:,None]*numNets + restPreferences).ravel(),minlength=nParcels*numNets).reshape((nParcels,numNets))
+    restMode = np.argmax(prefCounts,axis=1)
+    restModeCount = np.max(prefCounts,axis=1)
+    percentAgree = restModeCount / numSubjs
 
-    restConsensus = np.zeros((nParcels))
-    for netNum in range(numNets):
-        startNode = netBoundaries[netNum,0].astype(int)
-        endNode = (netBoundaries[netNum,1]+1).astype(int)
-        for nodeNum in range(startNode,endNode):
-            thisNode = percentAgree[nodeNum]
-            if thisNode<0.5:
-                restConsensus[nodeNum] = netNum
-            elif thisNode>=0.5:
-                restConsensus[nodeNum] = restMode[nodeNum]
+    # Nodes with < 50% agreement keep their original network (network index of each sorted node, from the network sizes)
+    origNetIxs = np.repeat(np.arange(numNets),netBoundaries[:,2].astype(int))
+    restConsensus = np.where(percentAgree<0.5,origNetIxs,restMode).astype(float)
 
     # generate netBoundariesNew array for use in other cells (to replace netBoundaries)
     nodeIndicesNew = np.sort(restConsensus)
     nodeOrderNew = np.argsort(restConsensus)
+    # nodeIndicesNew is sorted, so each network's first/last node comes from 1 binary search per side
+    netStarts = np.searchsorted(nodeIndicesNew,np.arange(numNets),side='left')
+    netEnds = np.searchsorted(nodeIndicesNew,np.arange(numNets),side='right') - 1
     netBoundariesNew = np.zeros((numNets,3))
-    for netNum in range(numNets):
-        finder = np.where(nodeIndicesNew==netNum)[0]
-        vals = [np.min(finder),np.max(finder)]
-        valVec = np.arange(np.min(finder),np.max(finder)+1)
-        sampSize = valVec.shape[0]
-        netBoundariesNew[netNum,0:2] = vals
-        netBoundariesNew[netNum,2] = sampSize
+    netBoundariesNew[:,0] = netStarts
+    netBoundariesNew[:,1] = netEnds
+    netBoundariesNew[:,2] = netEnds - netStarts + 1
         
     return netBoundariesNew, nodeOrderNew, restPreferences, percentAgree, restConsensus, nodeIndicesNew
\ No newline at end of file
@@ -14,84 +14,48 @@ def deviation(fcArray,netBoundaries,nodeOrder,useMeanFirst=False,useRestPartitio
     nParcels = fcArray.shape[0]
     numTasks = fcArray.shape[2]
     numSubjs = fcArray.shape[3]
+    # Network membership matrix (networks x sorted nodes): 1 where a node belongs to a network, so clustering is a matrix product
+    startNodes = boundariesHere[:,0].astype(int)
+    endNodes = (boundariesHere[:,1]+1).astype(int)
+    netSizes = endNodes - startNodes
+    netMembership = np.zeros((numNets,nParcels))
+    for netNum in range(numNets):
+        netMembership[netNum,startNodes[netNum]:endNodes[netNum]] = 1
+
+    # Sort FC to the partition once for all tasks and subjects: compose the two node orders, then 1 gather over the node axes
+    if useRestPartitionAdjuster:
+        print('Task FC: estimated with combinedFC & nodes sorted/clustered per empirically-adjusted CAB-NP')
+        sortOrder = np.asarray(nodeOrder)[nodeOrderNew] # same as [nodeOrder,:][:,nodeOrder][nodeOrderNew,:][:,nodeOrderNew]
+    elif not useRestPartitionAdjuster:
+        print('Task FC: estimated with combinedFC & nodes sorted/clustered per original CAB-NP')
+        sortOrder = np.asarray(nodeOrder)
+    fcSorted = np.ascontiguousarray(fcArray[np.ix_(sortOrder,sortOrder)])
+    fcValid = (~np.isnan(fcSorted)).astype(float) # NaNs are left out of the network means (same as np.nanmean)
+    fcZeroed = np.nan_to_num(fcSorted)
         
     if useMeanFirst:
         # Cluster FC vals down to network-level (weighted avg) --> [node x network x task FC matrices]
         print('Clustering FC values down to the network level (weighted average) --> node x network x task FC matrices...')
-        clusteredTaskFC = np.zeros((nParcels,numNets,numTasks))
-        tempNet = np.zeros((numNets))
-        tempTask = np.zeros((nParcels,numNets))
-        for ruleSet in range(numTasks):
-            if useRestPartitionAdjuster:
-                if ruleSet==0: 
-                    print('Task FC: estimated with combinedFC & nodes sorted/clustered per empirically-adjusted CAB-NP')
-                thisTaskHere = fcArray[:,:,ruleSet]
-                thisTask = thisTaskHere[nodeOrder,:][:,nodeOrder][nodeOrderNew,:][:,nodeOrderNew]
-            elif not useRestPartitionAdjuster:
-                if ruleSet==0: 
-                    print('Task FC: estimated with combinedFC & nodes sorted/clustered per original CAB-NP')
-                thisTaskHere = fcArray[:,:,ruleSet]
-                thisTask = thisTaskHere[nodeOrder,:][:,nodeOrder]
-            for nodeNum in range(nParcels):
-                thisNodeVec = thisTask[nodeNum,:]
-                for netNum in range(numNets):
-                    startNode = boundariesHere[netNum,0].astype(int)
-                    endNode = (boundariesHere[netNum,1]+1).astype(int)
-                    thisCluster = thisNodeVec[startNode:endNode]
-                    clusterMean = np.nanmean(thisCluster)
-                    tempNet[netNum] = clusterMean
-                tempTask[nodeNum,:] = tempNet
-            clusteredTaskFC[:,:,ruleSet] = tempTask
+        clusteredTaskFC = np.einsum('ijts,mj->imt',fcZeroed,netMembership,optimize=True) / np.einsum('ijts,mj->imt',fcValid,netMembership,optimize=True) # mean over network nodes and subjects
 
         # Find max FC values and indices (e.g., connecting node number) of net means from above --> [node x task preference matrix]
         print('Finding max FC values and their indices (e.g., connecting node number) --> node x task preference matrices...');
-        tempNodeVecPrefs = np.zeros((nParcels))
-        nodePrefValsMeanFirst = np.zeros((nParcels,numTasks))
-        tempNodeVecIdxs = np.zeros((nParcels))
-        nodePrefIdxs = np.zeros((nParcels,numTasks))
-        for ruleSet in range(numTasks):
-            thisTask = clusteredTaskFC[:,:,ruleSet]
-            for nodeNum in range(nParcels):
-                thisNodeVec = thisTask[nodeNum,:]
-                maxVal = np.max(thisNodeVec)
-                maxIdx = np.argmax(thisNodeVec)
-                tempNodeVecPrefs[nodeNum] = maxVal
-                tempNodeVecIdxs[nodeNum] = maxIdx
-            nodePrefValsMeanFirst[:,ruleSet] = tempNodeVecPrefs
-            nodePrefIdxs[:,ruleSet] = tempNodeVecIdxs
+        nodePrefValsMeanFirst = np.max(clusteredTaskFC,axis=1)
+        nodePrefIdxs = np.argmax(clusteredTaskFC,axis=1).astype(float)
 
         # Iterating over all networks: test if preference index is a member of that network --> [node x task x network binarized affinity matrix]
         print('Iterating over all networks to test if the preference '+
               'index (ie max from above) is a member of that network --> node x task x network binarized affinity matrices...')
-        maxMembershipsTF = np.zeros((nParcels,numTasks,numNets))
-        maxMembershipsMean = np.zeros((nParcels,numTasks,numNets))
-        for nodeNum in range(nParcels):
-            thisNodeVec = nodePrefIdxs[nodeNum,:]
-            for netNum in range(numNets):
-                memberTF = (thisNodeVec==netNum)*1
-                maxMembershipsTF[nodeNum,:,netNum] = memberTF # kept binary
-                maxMembershipsMean[nodeNum,:,netNum] = memberTF * netNum # to get netIdx
+        maxMembershipsTF = (nodePrefIdxs[:,:,None]==np.arange(numNets)[None,None,:]).astype(np.int8) # kept binary; 1 broadcast over all networks
+        maxMembershipsMean = maxMembershipsTF * np.arange(numNets,dtype=np.int8) # to get netIdx
 
         # Find affinity scores (relative frequencies or RFs) for all connecting networks --> [node x network relative freq NPA values]
         print('Finding affinity scores (relative frequencies) for all connecting networks --> node x network x relative frequency NPA matrices...')
-        netAffinities = np.zeros((nParcels,numNets))
-        for netNum in range(numNets):
-            thisNet = maxMembershipsTF[:,:,netNum]
-            for nodeNum in range(nParcels):
-                thisNodeVec = thisNet[nodeNum,:]
-                thisNodeSum = np.sum(thisNodeVec)
-                thisNodeRF = thisNodeSum / numTasks # Tally --> RF
-                netAffinities[nodeNum,netNum] = thisNodeRF # Each row should add to 1 with np.sum(netAffinities,axis=1)
+        netAffinities = np.sum(maxMembershipsTF,axis=1) / numTasks # Tally --> RF; each row should add to 1 with np.sum(netAffinities,axis=1)
 
         # Cluster ROIs into NOIs --> [network x network relative frequency NPA values]
         print('Clustering ROIs into NOIs --> network x network relative frequency NPA matrices...')
-        clusteredAffinities = np.zeros((numNets,numNets))
-        for netNum in range(numNets):
-            startNode = boundariesHere[netNum,0].astype(int)
-            endNode = (boundariesHere[netNum,1]+1).astype(int)
-            thisCluster = netAffinities[startNode:endNode,:]
-            clusterMeanRFs = np.nanmean(thisCluster,axis=0) # should still add to 1 per row
-            clusteredAffinities[netNum,:] = clusterMeanRFs
+        clusteredAffinities = np.einsum('mn,nk->mk',netMembership,netAffinities) / netSizes[:,None] # should still add to 1 per row
 
         # Sanity check: they all add to 100% 
         print('Sanity check that all clustered affinities add to 100%...');
@@ -114,86 +78,26 @@ def deviation(fcArray,netBoundaries,nodeOrder,useMeanFirst=False,useRestPartitio
     elif not useMeanFirst:
         # Cluster FC vals down to network-level (weighted avg) --> [node x network x task FC matrices]
         print('Clustering FC values down to the network level (weighted average) --> node x network x task x subject FC matrices...')
-        clusteredTaskFC = np.zeros((nParcels,numNets,numTasks,numSubjs))
-        tempNet = np.zeros((numNets))
-        tempTask = np.zeros((nParcels,numNets))
-        for subjNum in range(numSubjs):
-            for taskNum in range(numTasks):
-                if useRestPartitionAdjuster:
-                    if taskNum==0 and subjNum==0: 
-                        print('Task FC: estimated with combinedFC & nodes sorted/clustered per empirically-adjusted CAB-NP')
-                    thisTaskHere = fcArray[:,:,taskNum,subjNum]
-                    thisTask = thisTaskHere[nodeOrder,:][:,nodeOrder][nodeOrderNew,:][:,nodeOrderNew]
-                elif not useRestPartitionAdjuster:
-                    if taskNum==0 and subjNum==0: 
-                        print('Task FC: estimated with combinedFC & nodes sorted/clustered per original CAB-NP')
-                    thisTaskHere = fcArray[:,:,taskNum,subjNum]
-                    thisTask = thisTaskHere[nodeOrder,:][:,nodeOrder]
-                for nodeNum in range(nParcels):
-                    thisNodeVec = thisTask[nodeNum,:]
-                    for netNum in range(numNets):
-                        startNode = boundariesHere[netNum,0].astype(int)
-                        endNode = (boundariesHere[netNum,1]+1).astype(int)
-                        thisCluster = thisNodeVec[startNode:endNode]
-                        clusterMean = np.nanmean(thisCluster)
-                        tempNet[netNum] = clusterMean
-                    tempTask[nodeNum,:] = tempNet
-                clusteredTaskFC[:,:,taskNum,subjNum] = tempTask
+        clusteredTaskFC = np.einsum('ijts,mj->imts',fcZeroed,netMembership,optimize=True) / np.einsum('ijts,mj->imts',fcValid,netMembership,optimize=True)
 
         # Find max FC values and indices (e.g., connecting node number) of net means from above --> [node x task preference matrix]
         print('Finding max FC values and their indices (e.g., connecting node number) --> node x task x subject preference matrices...')
-        tempNodeVecPrefs = np.zeros((nParcels))
-        nodePrefValsMeanFirst = np.zeros((nParcels,numTasks,numSubjs))
-        tempNodeVecIdxs = np.zeros((nParcels))
-        nodePrefIdxs = np.zeros((nParcels,numTasks,numSubjs))
-        for subjNum in range(numSubjs):
-            for taskNum in range(numTasks):
-                thisTask = clusteredTaskFC[:,:,taskNum,subjNum]
-                for nodeNum in range(nParcels):
-                    thisNodeVec = thisTask[nodeNum,:]
-                    maxVal = np.max(thisNodeVec)
-                    maxIdx = np.argmax(thisNodeVec)
-                    tempNodeVecPrefs[nodeNum] = maxVal
-                    tempNodeVecIdxs[nodeNum] = maxIdx
-                nodePrefValsMeanFirst[:,taskNum,subjNum] = tempNodeVecPrefs
-                nodePrefIdxs[:,taskNum,subjNum] = tempNodeVecIdxs
+        nodePrefValsMeanFirst = np.max(clusteredTaskFC,axis=1)
+        nodePrefIdxs = np.argmax(clusteredTaskFC,axis=1).astype(float)
 
         # Iterating over all networks: test if preference index is a member of that network --> [node x task x network binarized affinity matrix]
         print('Iterating over all networks to test if the preference index '+
               '(ie max from above) is a member of that network --> node x task x network x subject binarized affinity matrices...')
-        maxMembershipsTF = np.zeros((nParcels,numTasks,numNets,numSubjs))
-        maxMembershipsMean = np.zeros((nParcels,numTasks,numNets,numSubjs))
-        for subjNum in range(numSubjs):
-            for nodeNum in range(nParcels):
-                thisNodeVec = nodePrefIdxs[nodeNum,:,subjNum]
-                for netNum in range(numNets):
-                    memberTF = (thisNodeVec==netNum)*1
-                    maxMembershipsTF[nodeNum,:,netNum,subjNum] = memberTF # kept binary
-                    maxMembershipsMean[nodeNum,:,netNum,subjNum] = memberTF * netNum # to get netIdx
+        maxMembershipsTF = (nodePrefIdxs[:,:,None,:]==np.arange(numNets)[None,None,:,None]).astype(np.int8) # kept binary; 1 broadcast over all networks and subjects
+        maxMembershipsMean = maxMembershipsTF * np.arange(numNets,dtype=np.int8)[:,None] # to get netIdx
 
         # Find affinity scores (relative frequencies or RFs) for all connecting networks --> [node x network relative freq NPA values]
         print('Finding affinity scores (relative frequencies) for all connecting networks --> node x network x relative frequency NPA matrices...')
-        netAffinities = np.zeros((nParcels,numNets,numSubjs))
-        for subjNum in range(numSubjs):
-            for netNum in range(numNets):
-                thisNet = maxMembershipsTF[:,:,netNum,subjNum]
-                for nodeNum in range(nParcels):
-                    thisNodeVec = thisNet[nodeNum,:]
-                    thisNodeSum = np.sum(thisNodeVec)
-                    thisNodeRF = thisNodeSum / numTasks # Tally --> RF
-                    netAffinities[nodeNum,netNum,subjNum] = thisNodeRF # Each row should add to 1 with np.sum(netAffinities,axis=1)
+        netAffinities = np.sum(maxMembershipsTF,axis=1) / numTasks # Tally --> RF; each row should add to 1 with np.sum(netAffinities,axis=1)
 
         # Cluster ROIs into NOIs --> [network x network relative frequency NPA values]
         print('Clustering ROIs into NOIs --> network x network x subject relative frequency NPA matrices...')
-        clusteredAffinities = np.zeros((numNets,numNets,numSubjs))
-        for subjNum in range(numSubjs):
-            thisSubj = netAffinities[:,:,subjNum]
-            for netNum in range(numNets):
-                startNode = boundariesHere[netNum,0].astype(int)
-                endNode = (boundariesHere[netNum,1]+1).astype(int)
-                thisCluster = thisSubj[startNode:endNode,:]
-                clusterMeanRFs = np.nanmean(thisCluster,axis=0) # should still add to 1 per row
-                clusteredAffinities[netNum,:,subjNum] = clusterMeanRFs 
+        clusteredAffinities = np.einsum('mn,nks->mks',netMembership,netAffinities) / netSizes[:,None,None] # should still add to 1 per row
 
         # Sanity check: they all add to 100% 
         print('Sanity check that all clustered affinities add to 100%...');
@@ -206,9 +110,7 @@ def deviation(fcArray,netBoundaries,nodeOrder,useMeanFirst=False,useRestPartitio
 
         # Pulling out adherence to pre-defined network partition --> [network x 1] NPA vector 
         print('Pulling out adherence to pre-defined network partition --> network x subject NPA matrices...')
-        adherenceRFs = np.zeros((numNets,numSubjs))
-        for subjNum in range(numSubjs):
-            adherenceRFs[:,subjNum] = np.diag(clusteredAffinities[:,:,subjNum])
+        adherenceRFs = np.diagonal(clusteredAffinities,axis1=0,axis2=1).T # network x subject
 
         # Calculating deviation (NPD) as 1-NPA --> [network x 1] NPD vector 
         print('Computing deviation (NPD) --> network x subject NPD matrices...')
@@ -13,28 +13,39 @@ import numpy as np
 import nibabel as nib
 import scipy.io as spio
 import math as math
+from collections import namedtuple
+from functools import lru_cache
 
 ################################################
 # HELPER VARIABLES  ***** TBA: make these available on MAF project GitHub & change call to Amarel directory (Cole lab HPC) *****
 
 dirHere = '/projects/f_mc1689_1/MovieActFlow/docs/scripts/HCP_3T_7Task/'
 
-# General ordering info relating MMP and CAB-NP
-nodeIndices = spio.loadmat(dirHere + 'nodeIndices.mat')['nodeIndices'][:,0] # 360,, network assignment (CAB-NP) numbers 1-12
-nodeOrder = (spio.loadmat(dirHere + 'nodeOrder.mat')['nodeOrder'] - 1)[:,0] # 360, node order into networks (CAB-NP) 
+AtlasInfo = namedtuple('AtlasInfo',['nodeIndices','nodeOrder','leftNodes','rightNodes','netRef'])
 
-# Left nodes: 32492 vector, left hemisphere cortical vertex labels (label = Glasser parcel, or NaN)
-ciftiFileLeft = dirHere + 'Q1-Q6_RelatedValidation210.L.CorticalAreas_dil_Final_Final_Areas_Group_Colors.32k_fs_LR.dlabel.nii'
-leftNodes = nib.load(ciftiFileLeft).get_fdata()
-leftNodes = np.squeeze(leftNodes)
+@lru_cache(maxsize=1)
+def _load_atlas():
+    '''
+    Loads the helper variables (once; later calls reuse the cached copy), so nothing is read from disk until glasser_ordering is called.
+    '''
+    # General ordering info relating MMP and CAB-NP
+    nodeIndices = spio.loadmat(dirHere + 'nodeIndices.mat')['nodeIndices'][:,0] # 360,, network assignment (CAB-NP) numbers 1-12
+    nodeOrder = (spio.loadmat(dirHere + 'nodeOrder.mat')['nodeOrder'] - 1)[:,0] # 360, node order into networks (CAB-NP) 
 
-# Right nodes: 32492 vector, right hemisphere cortical vertex labels (label = Glasser parcel, or NaN)
-ciftiFileRight = dirHere + 'Q1-Q6_RelatedValidation210.R.CorticalAreas_dil_Final_Final_Areas_Group_Colors.32k_fs_LR.dlabel.nii'
-rightNodes = nib.load(ciftiFileRight).get_fdata()
-rightNodes = np.squeeze(rightNodes)
+    # Left nodes: 32492 vector, left hemisphere cortical vertex labels (label = Glasser parcel, or NaN)
+    ciftiFileLeft = dirHere + 'Q1-Q6_RelatedValidation210.L.CorticalAreas_dil_Final_Final_Areas_Group_Colors.32k_fs_LR.dlabel.nii'
+    leftNodes = nib.load(ciftiFileLeft).get_fdata()
+    leftNodes = np.squeeze(leftNodes)
 
-# Network references: 96854 vector, whole brain vertex labels (label = CABNP network 1-12, or NaN)
-netRef = spio.loadmat(dirHere + 'netRefNew.mat')['netRefNew'] # 96854 x 1, whole brain vertex labels (label = CABNP network 1-12, or NaN); NOTE: hand fixed 
+    # Right nodes: 32492 vector, right hemisphere cortical vertex labels (label = Glasser parcel, or NaN)
+    ciftiFileRight = dirHere + 'Q1-Q6_RelatedValidation210.R.CorticalAreas_dil_Final_Final_Areas_Group_Colors.32k_fs_LR.dlabel.nii'
+    rightNodes = nib.load(ciftiFileRight).get_fdata()
+    rightNodes = np.squeeze(rightNodes)
+
+    # Network references: 96854 vector, whole brain vertex labels (label = CABNP network 1-12, or NaN)
+    netRef = spio.loadmat(dirHere + 'netRefNew.mat')['netRefNew'] # 96854 x 1, whole brain vertex labels (label = CABNP network 1-12, or NaN); NOTE: hand fixed 
+    
+    return AtlasInfo(nodeIndices,nodeOrder,leftNodes,rightNodes,netRef)
 
 nParcels = 360
 numNets = 12
@@ -53,13 +64,16 @@ def glasser_ordering(dataVectorSorted):
     '''
     ################################################
     # SET-UP
-    orderedVec = nodeIndices[nodeOrder]
-    newOrder = np.zeros((nParcels))
-    for netNum in range(1,numNets+1):
-        orderedFinder = np.where(orderedVec==netNum)[0]
-        refFinder = np.where(nodeIndices==netNum)[0]
-        newOrder[refFinder] = orderedFinder
-    vecReOrdered = dataVectorSorted[newOrder.astype(int)]
+    atlas = _load_atlas()
+    nodeIndices = atlas.nodeIndices
+    leftNodes = atlas.leftNodes
+    rightNodes = atlas.rightNodes
+    netRef = atlas.netRef
+    orderedVec = nodeIndices[atlas.nodeOrder]
+    # The k-th MMP node of each network takes the k-th sorted position of that network: a stable sort by network of both vectors lines these up
+    newOrder = np.zeros((nParcels),dtype=int)
+    newOrder[np.argsort(nodeIndices,kind='stable')] = np.argsort(orderedVec,kind='stable')
+    vecReOrdered = dataVectorSorted[newOrder]
 
     # Write over vertex labels with parcel-appropriate dataVectorSorted values, L-->R
     numBalsa = len(leftNodes)
@@ -68,28 +82,13 @@ def glasser_ordering(dataVectorSorted):
     netRefRight = netRef[numBalsa:maxBalsa]
     newRegionVec = np.zeros((numTotal))
     
-    # Left hemisphere
-    for vertNum in range(numBalsa):
-        parcelIx = leftNodes[vertNum]
-        testNaN = parcelIx==0
-        if testNaN:
-            newRegionVec[vertNum] = math.nan
-            newRegionVec[vertNum] = 0
-        else:
-            adjIndexHemi = parcelIx - (nParcels/2)
-            newRegionVec[vertNum] = vecReOrdered[adjIndexHemi.astype(int) - 1] # -1 for python
+    # Left hemisphere (label 0 = no parcel --> 0)
+    adjIndexHemi = (leftNodes - (nParcels/2)).astype(int) - 1 # -1 for python
+    newRegionVec[:numBalsa] = np.where(leftNodes==0,0,vecReOrdered[adjIndexHemi])
 
-    # Right hemisphere
-    for vertNum in range(numBalsa,maxBalsa):
-        adjIndex = vertNum - numBalsa
-        parcelIx = rightNodes[adjIndex]
-        testNaN = parcelIx==0
-        if testNaN:
-            newRegionVec[vertNum] = math.nan
-            newRegionVec[vertNum] = 0
-        else:
-            adjIndexHemi = parcelIx + (nParcels/2)
-            newRegionVec[vertNum] = vecReOrdered[adjIndexHemi.astype(int) - 1] # -1 for python
+    # Right hemisphere (label 0 = no parcel --> 0)
+    adjIndexHemi = (rightNodes + (nParcels/2)).astype(int) - 1 # -1 for python
+    newRegionVec[numBalsa:maxBalsa] = np.where(rightNodes==0,0,vecReOrdered[adjIndexHemi])
     newRegionVec[maxBalsa:] = math.nan
     
     dataVector = vecReOrdered.copy()